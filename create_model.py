@@ -1,31 +1,117 @@
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import fields
+from functools import lru_cache
+from typing import List, Optional
+import copy
+import math
+import os
 import yaml
 import femm
 
 
+from femm_session import close_femm, open_femm, run_lua
 from motor_dataclasses import Magnet, Coil
 from model_builders.magnets import create_magnets
 from model_builders.coils import create_coils
 from model_builders.boundaries import create_auto_boundary
+from model_builders.lua_batch import LuaBatch
+
+try:
+    from yaml import CSafeLoader as _Loader
+except ImportError:
+    from yaml import SafeLoader as _Loader
+
+# Required fields for Magnet and Coil
+_REQUIRED_MAGNET = ("number", "pitch", "length", "od", "material")
+_REQUIRED_COIL = ("number", "pitch", "length", "od", "id", "nb_turn", "material")
+
+# Material fields of each section, known statically from the dataclasses
+_MAGNET_MATERIAL_FIELDS = tuple(f.name for f in fields(Magnet) if "material" in f.name)
+_COIL_MATERIAL_FIELDS = tuple(f.name for f in fields(Coil) if "material" in f.name)
+
+_MAGNET_FIELDS = frozenset(f.name for f in fields(Magnet))
+_COIL_FIELDS = frozenset(f.name for f in fields(Coil))
+# Optional Boundary section
+_BOUNDARY_FIELDS = frozenset(("air_mesh_size",))
+
+
+@lru_cache(maxsize=32)
+def _parse_yaml(path: str, mtime_ns: int, size: int):
+    """Parse a YAML file, cached on its path, modification time and size."""
+    with open(path, "r", encoding="utf-8") as f:
+        return yaml.load(f, Loader=_Loader)
+
+
+def _section_kwargs(section_name: str, section_data: dict, field_names: frozenset) -> dict:
+    """Map a YAML section to dataclass keyword arguments."""
+    kwargs = {k.lower(): v for k, v in section_data.items()}
+    unknown = kwargs.keys() - field_names
+    if unknown:
+        raise ValueError(f"Unknown parameter(s) in {section_name}: {', '.join(sorted(unknown))}")
+    return kwargs
 
 
 class CreateModel:
     """Handles creating a FEMM model, translating, and solving a FEMM model."""
 
-    def __init__(self, model_path: Path):
+    __slots__ = (
+        "model_path",
+        "params_dict",
+        "magnet_params",
+        "coil_params",
+        "exp_factor",
+        "moving_mass",
+        "output_path",
+        "verbose",
+        "air_mesh_size",
+        "_owns_femm",
+    )
+
+    def __init__(self, model_path: Path, output_path: Optional[Path] = None, verbose: bool = True):
         self.model_path = model_path
         self.params_dict = {}
         self.magnet_params = None
         self.coil_params = None
         self.exp_factor = 0.5
         self.moving_mass = 0
-        self.output_path = Path.cwd() / "SimGenerated.fem"
+        self.output_path = output_path if output_path is not None else Path.cwd() / "SimGenerated.fem"
+        # Report the materials found and loaded, failures are always reported
+        self.verbose = verbose
+        # Air element size (mm) from the optional Boundary section, automesh if None
+        self.air_mesh_size = None
+        # Set by build: whether it started the FEMM instance, closed on exit if so
+        self._owns_femm = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Close the FEMM instance used to build the model, if build started it."""
+        if self._owns_femm:
+            close_femm()
+            self._owns_femm = False
+
+    @classmethod
+    def build_many(cls, paths: List[Path], workers: Optional[int] = None) -> List[Path]:
+        """
+        Build one model per YAML file in parallel worker processes.
+        Each worker runs its own FEMM instance and saves the model next to its YAML file
+        with a .fem extension. Returns the generated FEM file paths in input order.
+        """
+        if workers is None:
+            workers = max(1, (os.cpu_count() or 2) // 2)
+        output_paths = [Path(path).with_suffix(".fem") for path in paths]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(_build_model, paths, output_paths))
+        return output_paths
 
     def build(self):
         """Build the model from YAML file specified parameters"""
         self.load_model_parameters()
         self.validate_params()
-        femm.openfemm(1)
+        # Reuses the FEMM instance when one is already running in this process
+        self._owns_femm = open_femm() or self._owns_femm
         analysis_types = {
             "Magnetic": 0,
             "Electrostatic": 1,
@@ -35,19 +121,24 @@ class CreateModel:
         femm.newdocument(analysis_types["Magnetic"])
         femm.mi_probdef(0, "millimeters", "axi")
         self.import_materials_property()
-        self.create_circuits()
-        self.create_magnets()
-        self.create_coils()
-        self.create_auto_boundary()
+        # Circuits and geometry are sent to FEMM as a single Lua script
+        batch = LuaBatch()
+        self.create_circuits(batch)
+        self.create_magnets(batch)
+        self.create_coils(batch)
+        self.create_auto_boundary(batch)
+        run_lua(batch.flush())
         femm.mi_saveas(str(self.output_path))
 
     def load_model_parameters(self):
         """Import model parameters from YAML file."""
         try:
-            with open(self.model_path, "r", encoding="utf-8") as f:
-                self.params_dict = yaml.safe_load(f)
-                if not isinstance(self.params_dict, dict):
-                    raise ValueError("YAML root must be a dictionary")
+            stat = os.stat(self.model_path)
+            params = _parse_yaml(str(self.model_path), stat.st_mtime_ns, stat.st_size)
+            # The cached object is shared between builds, hand out a private copy
+            self.params_dict = copy.deepcopy(params)
+            if not isinstance(self.params_dict, dict):
+                raise ValueError("YAML root must be a dictionary")
         except FileNotFoundError:
             raise FileNotFoundError(f"Model file not found: {self.model_path}")
         except yaml.YAMLError as e:
@@ -59,8 +150,10 @@ class CreateModel:
     def _load_objects(self):
         magnet_data = self.params_dict.get("Magnet", {})
         coil_data = self.params_dict.get("Coil", {})
-        self.magnet_params = Magnet(**{k.lower(): v for k, v in magnet_data.items()})
-        self.coil_params = Coil(**{k.lower(): v for k, v in coil_data.items()})
+        self.magnet_params = Magnet(**_section_kwargs("Magnet", magnet_data, _MAGNET_FIELDS))
+        self.coil_params = Coil(**_section_kwargs("Coil", coil_data, _COIL_FIELDS))
+        boundary_data = self.params_dict.get("Boundary") or {}
+        self.air_mesh_size = _section_kwargs("Boundary", boundary_data, _BOUNDARY_FIELDS).get("air_mesh_size")
 
     def validate_params(self):
         """Checks that the yaml file contains necessary keys."""
@@ -70,22 +163,27 @@ class CreateModel:
         if "Magnet" not in self.params_dict:
             raise ValueError("Missing required section: 'Magnet'")
 
-        # List of required fields for Magnet and Coil
-        required_magnet = ["number", "pitch", "length", "od", "material"]
-        required_coil = ["number", "pitch", "length", "od", "id", "nb_turn", "material"]
-
         # Check Magnet fields
-        for field in required_magnet:
-            value = getattr(self.magnet_params, field, None)
-            if value is None:
+        magnet_params = self.magnet_params
+        for field in _REQUIRED_MAGNET:
+            if getattr(magnet_params, field, None) is None:
                 raise ValueError(f"Missing or null parameter in Magnet: '{field}'")
 
         # Check Coil fields
-        for field in required_coil:
-            value = getattr(self.coil_params, field, None)
-            if value is None:
+        coil_params = self.coil_params
+        for field in _REQUIRED_COIL:
+            if getattr(coil_params, field, None) is None:
                 raise ValueError(f"Missing or null parameter in Coil: '{field}'")
 
+        # Check the optional air mesh size, written as is in the geometry script
+        if self.air_mesh_size is not None:
+            try:
+                self.air_mesh_size = float(self.air_mesh_size)
+            except (TypeError, ValueError):
+                raise ValueError(f"Boundary 'air_mesh_size' must be a number, got: {self.air_mesh_size!r}")
+            if not (math.isfinite(self.air_mesh_size) and self.air_mesh_size > 0):
+                raise ValueError(f"Boundary 'air_mesh_size' must be positive, got: {self.air_mesh_size}")
+
     def get_param(self, *keys, default=None):
         """Access a nested parameter using a sequence of keys."""
         current = self.params_dict
@@ -99,17 +197,22 @@ class CreateModel:
 
     def import_materials_property(self):
         """Add materials to project library."""
-        material_names = set()
-        found_materials = {}
-        material_names.add("Air")
-        for section_name, section_data in self.params_dict.items():
-            if isinstance(section_data, dict):
-                for key, value in section_data.items():
-                    if "material" in key.lower() and isinstance(value, str):
-                        found_materials.setdefault(section_name, set()).add(value)
-                        material_names.add(value)
-        for section, materials in found_materials.items():
-            print(f"Found materials in {section}: {', '.join(sorted(materials))}")
+        found_materials = {
+            section_name: {
+                value
+                for value in (getattr(section_params, name) for name in material_fields)
+                if isinstance(value, str)
+            }
+            for section_name, section_params, material_fields in (
+                ("Magnet", self.magnet_params, _MAGNET_MATERIAL_FIELDS),
+                ("Coil", self.coil_params, _COIL_MATERIAL_FIELDS),
+            )
+        }
+        material_names = {"Air"}.union(*found_materials.values())
+        if self.verbose:
+            for section, materials in found_materials.items():
+                if materials:
+                    print(f"Found materials in {section}: {', '.join(sorted(materials))}")
         added = []
         failed = []
         for material_name in sorted(material_names):
@@ -118,28 +221,34 @@ class CreateModel:
                 added.append(material_name)
             except Exception as e:
                 failed.append((material_name, str(e)))
-        if added:
+        if added and self.verbose:
             print(f"✔ Added materials: {', '.join(added)}")
         if failed:
             print("⚠ Some materials could not be added:")
             for name, reason in failed:
                 print(f"  - {name}: {reason}")
 
-    def create_circuits(self):
+    def create_circuits(self, batch: LuaBatch):
         """Create 3 coil circuits CoilA, CoilB and CoilC."""
         for coil_label in ["A", "B", "C"]:
             circuit_name = f"Coil{coil_label}"
-            femm.mi_addcircprop(circuit_name, 0, 1)
+            batch.mi_addcircprop(circuit_name, 0, 1)
 
-    def create_magnets(self):
+    def create_magnets(self, batch: LuaBatch):
         """Create magnets using external builder."""
-        create_magnets(femm, self.magnet_params)
+        create_magnets(batch, self.magnet_params)
 
 
-    def create_coils(self):
+    def create_coils(self, batch: LuaBatch):
         """Create coils using external builder."""
-        create_coils(femm, self.coil_params)
+        create_coils(batch, self.coil_params)
 
-    def create_auto_boundary(self):
+    def create_auto_boundary(self, batch: LuaBatch):
         """Create boundary using external builder."""
-        create_auto_boundary(femm, self.coil_params, self.magnet_params)
+        create_auto_boundary(batch, self.coil_params, self.magnet_params, self.air_mesh_size)
+
+
+def _build_model(model_path: Path, output_path: Path):
+    """Build a single model in a worker process, closing its FEMM instance afterwards."""
+    with CreateModel(Path(model_path), output_path, verbose=False) as model_builder:
+        model_builder.build()
@@ -1,9 +1,33 @@
 from pathlib import Path
-from dataclasses import dataclass, field
-from typing import Dict
+from dataclasses import dataclass
+from typing import Optional, Sequence, Tuple
 import math
+import os
+import tempfile
+import weakref
+import numpy as np
 import femm
 
+from femm_session import close_femm, open_femm, run_lua
+
+_COILS = ("CoilA", "CoilB", "CoilC")
+# Phase of coils A, B and C, and cos/sin of the +/- 120 degrees shift of B and C
+_PHASES = np.array([0.0, math.tau / 3, -math.tau / 3])
+_COS_120 = -0.5
+_SIN_120 = math.sqrt(3) / 2
+
+# Coils (groups 1 to 3) and their spools/spacers (group 4) move together
+_SELECT_MOVING_GROUPS_LUA = "\n".join(
+    ["mi_clearselected()", 'mi_seteditmode("group")']
+    + [f"mi_selectgroup({group_id})" for group_id in range(1, 5)]
+)
+
+
+def _remove_scratch_files(fem_path: Path):
+    """Remove a scratch model and its solution file."""
+    fem_path.unlink(missing_ok=True)
+    fem_path.with_suffix(".ans").unlink(missing_ok=True)
+
 
 @dataclass
 class FEMMModel:
@@ -12,42 +36,91 @@ class FEMMModel:
     pole_length: float
     coil_pitch: float
     model_path: Path
-    output_path: Path = field(default_factory=lambda: Path("out/SimOutput.fem"))
+    # Model saved and solved at each step, a per-process scratch file in the temp dir if None
+    output_path: Optional[Path] = None
     offset_pos: float = 0.0
-    currents: Dict[str, float] = field(default_factory=dict)
+    # Coil A, B and C currents, replaced (never mutated) at each move
+    currents: Tuple[float, float, float] = (0.0, 0.0, 0.0)
 
     def __post_init__(self):
-        femm.openfemm(1)
-        femm.opendocument(str(self.model_path))
-        femm.mi_probdef(0, "millimeters", "axi")
+        # Reuses the FEMM instance left open by CreateModel.build in the same process,
+        # only an instance started here is closed with the model
+        self._owns_femm = open_femm()
+        try:
+            femm.opendocument(str(self.model_path))
+            femm.mi_probdef(0, "millimeters", "axi")
+        except Exception:
+            if self._owns_femm:
+                close_femm()
+            raise
+        self._remove_scratch = None
+        if self.output_path is None:
+            # Unique per process and per model, so parallel workers never share a file
+            fd, scratch_path = tempfile.mkstemp(prefix=f"SimOutput_{os.getpid()}_", suffix=".fem")
+            os.close(fd)
+            self.output_path = Path(scratch_path)
+            # Run by close(), or when the model is garbage collected or at exit if it never is
+            self._remove_scratch = weakref.finalize(self, _remove_scratch_files, self.output_path)
+        # Save and analyze are the same at every position: built once and sent as one Lua script.
+        # mi_analyze regenerates the mesh itself when the geometry changed, an explicit
+        # mi_createmesh beforehand only meshes the model a second time
+        self._solve_lua = f'mi_saveas("{self.output_path.resolve().as_posix()}")\nmi_analyze(0)'
+        # Electrical angle = _k_pos * position + _phase_offset, constant over the sweep
+        self._k_pos = math.tau / self.pole_length
+        self._phase_offset = math.tau * self.coil_pitch / self.pole_length
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Close FEMM if this model started it, and remove the scratch files, if any."""
+        if self._owns_femm:
+            close_femm()
+        if self._remove_scratch is not None:
+            self._remove_scratch()
 
     def mesh_and_solve(self):
         """Save, mesh, and run the simulation."""
-        femm.mi_saveas(self.output_path.resolve().as_posix())
-        femm.mi_createmesh()
-        femm.mi_analyze()
-
-    def compute_current_at_position(self, pos: float, phase: float = 0.0) -> float:
-        """Compute coil currents from position and model parameters"""
-        angle = (
-            2 * math.pi * pos / self.pole_length
-            + phase
-            + 2 * math.pi * self.coil_pitch / self.pole_length
-        )
-        return self.peak_current * math.sin(angle)
+        run_lua(self._solve_lua)
+
+    def compute_currents(self, positions) -> np.ndarray:
+        """Compute coil A, B and C currents for an array of positions, shape (n, 3)."""
+        positions = np.asarray(positions, dtype=float)
+        angles = self._k_pos * positions[:, None] + (self._phase_offset + _PHASES)
+        return self.peak_current * np.sin(angles)
+
+    def translate_to(self, position: float, currents: Optional[Sequence[float]] = None):
+        """
+        Move the coils to an absolute position and update coil currents.
+        currents (A, B, C) can be given when precomputed with compute_currents.
+        """
+        self._move(position - self.offset_pos, position, currents)
 
     def translate_and_set_currents(self, delta: float):
         """Translate the model and update coil currents."""
-        femm.mi_clearselected()
-        femm.mi_seteditmode("group")
-        for group_id in range(1, 5):
-            femm.mi_selectgroup(group_id)
-        femm.mi_movetranslate(0, delta)
-        self.offset_pos += delta
-        self.currents = {
-            "CoilA": self.compute_current_at_position(self.offset_pos, 0),
-            "CoilB": self.compute_current_at_position(self.offset_pos, 2 * math.pi / 3),
-            "CoilC": self.compute_current_at_position(self.offset_pos, -2 * math.pi / 3),
-        }
-        for coil, current in self.currents.items():
-            femm.mi_setcurrent(coil, current)
+        self._move(delta, self.offset_pos + delta)
+
+    def _move(self, delta: float, position: float, currents: Optional[Sequence[float]] = None):
+        """Translate the moving groups by delta, now located at position, and set currents."""
+        self.offset_pos = position
+        if currents is None:
+            # Same as compute_currents for a single position, with one sin/cos pair
+            # expanded with sin(a +/- b) = sin(a)cos(b) +/- cos(a)sin(b)
+            angle = self._k_pos * position + self._phase_offset
+            sin_a = self.peak_current * math.sin(angle)
+            cos_a = self.peak_current * math.cos(angle)
+            currents = (
+                sin_a,
+                sin_a * _COS_120 + cos_a * _SIN_120,
+                sin_a * _COS_120 - cos_a * _SIN_120,
+            )
+        self.currents = tuple(currents)
+        # Selection, translation and currents are sent as one Lua script
+        script = [_SELECT_MOVING_GROUPS_LUA, f"mi_movetranslate(0,{delta})"]
+        # pyfemm's mi_setcurrent is a Python helper, the Lua command is mi_modifycircprop
+        for coil, current in zip(_COILS, self.currents):
+            script.append(f'mi_modifycircprop("{coil}",1,{current})')
+        run_lua("\n".join(script))
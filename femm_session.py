@@ -0,0 +1,55 @@
+from pathlib import Path
+from typing import Sequence
+import os
+import tempfile
+import femm
+
+# FEMM instance of this process, shared by model building and simulation
+_is_open = False
+
+
+def open_femm() -> bool:
+    """
+    Start a hidden FEMM instance, unless this process already has one running.
+    Returns True when this call started it: the caller then owns it and closes it.
+    """
+    global _is_open
+    if _is_open:
+        return False
+    femm.openfemm(1)
+    _is_open = True
+    return True
+
+
+def close_femm():
+    """Close the FEMM instance of this process, if any."""
+    global _is_open
+    if _is_open:
+        femm.closefemm()
+        _is_open = False
+
+
+def run_lua(script: str, results: Sequence[str] = ()) -> list:
+    """
+    Run a multi-statement Lua script in FEMM with a single call and return the values of the
+    Lua expressions in results, evaluated at its end.
+    callfemm sends one expression only: the script is written to a temp file run by dofile.
+    Raises RuntimeError when the script fails, dofile then returns nil instead of its values.
+    """
+    fd, script_path = tempfile.mkstemp(prefix=f"FEMMScript_{os.getpid()}_", suffix=".lua")
+    try:
+        with os.fdopen(fd, "w") as script_file:
+            script_file.write(script)
+            # The leading 1 only comes back from a script that ran to its end
+            script_file.write("\nreturn " + ",".join(("1", *results)))
+        # An "error..." reply from FEMM is raised by callfemm itself
+        reply = femm.callfemm(f'dofile("{Path(script_path).as_posix()}")')
+    finally:
+        os.unlink(script_path)
+    # callfemm unwraps single values
+    if not isinstance(reply, list):
+        reply = [reply]
+    if len(reply) != len(results) + 1 or reply[0] != 1:
+        first_statement = script.partition("\n")[0]
+        raise RuntimeError(f"FEMM failed to run the Lua script starting with: {first_statement}")
+    return reply[1:]
@@ -1,15 +1,22 @@
 """
 Functions to build boundary geometry in FEMM.
 """
+import math
 
-def create_auto_boundary(femm, coil, magnet):
-    """Automatically create an open boundary region around the model."""
+
+def create_auto_boundary(batch, coil, magnet, air_mesh_size=None):
+    """
+    Automatically create an open boundary region around the model.
+    air_mesh_size sets an explicit element size (mm) for the air region instead of automesh.
+    The air region includes the gap between magnets and coils, so it must stay small
+    compared to the gap.
+    """
     r_max = max(coil.od / 2, magnet.od / 2)
     h_stack = (magnet.number - 1) * magnet.pitch + magnet.length
     h_max = h_stack / 2 + coil.length
-    model_radius = (r_max**2 + h_max**2) ** 0.5
+    model_radius = math.hypot(r_max, h_max)
     air_radius = model_radius * 1.5
-    femm.mi_makeABC(
+    batch.mi_makeABC(
         7,
         air_radius,
         0,
@@ -18,15 +25,16 @@ def create_auto_boundary(femm, coil, magnet):
     )
     air_x = air_radius / 2
     air_y = air_radius * 2 / 3
-    femm.mi_addblocklabel(air_x, air_y)
-    femm.mi_selectlabel(air_x, air_y)
-    femm.mi_setblockprop(
+    batch.mi_addblocklabel(air_x, air_y)
+    batch.mi_selectlabel(air_x, air_y)
+    automesh = 1 if air_mesh_size is None else 0
+    batch.mi_setblockprop(
         "Air",
-        1,
-        0,
+        automesh,
+        air_mesh_size or 0,
         "",
         0,
         0,
         0,
     )
-    femm.mi_clearselected()
+    batch.mi_clearselected()
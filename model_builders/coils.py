@@ -1,177 +1,154 @@
 """
 Functions to build coils geometry in FEMM.
 """
+from itertools import cycle, islice
+import numpy as np
 
+# Lua templates for the parts of a coil that share the same shape for every coil.
+# Inner and outer sides of a coil rectangle, top and bottom sides are added separately:
+# stacked parts can share them
+_COIL_SIDES_LUA = (
+    "mi_addsegment({x0:.10g},{y1:.10g},{x0:.10g},{y0:.10g})\n"
+    "mi_addsegment({x1:.10g},{y0:.10g},{x1:.10g},{y1:.10g})"
+)
+# Margin around a coil rectangle when selecting its segments, in mm
+_SELECT_MARGIN = 1e-3
+_COIL_BLOCK_LUA = (
+    "mi_addblocklabel({x:.10g},{y:.10g})\nmi_selectlabel({x:.10g},{y:.10g})\n"
+    'mi_setblockprop("{material}",1,0,"Coil{label}",0,{group},{turns})\nmi_clearselected()'
+)
 
-def create_coil_geometry(femm, x_start, r, y_center, half_length, group):
+
+def create_coil_geometry(batch, x_start, r, y_center, half_length, group):
     """Draw a single coil rectangle in FEMM."""
-    top_left = (x_start, y_center + half_length)
-    bottom_left = (x_start, y_center - half_length)
-    bottom_right = (r, y_center - half_length)
-    top_right = (r, y_center + half_length)
-    femm.mi_addnode(*top_left)
-    femm.mi_addnode(*bottom_left)
-    femm.mi_addnode(*bottom_right)
-    femm.mi_addnode(*top_right)
-    segments = [
-        (top_left, bottom_left),
-        (bottom_left, bottom_right),
-        (bottom_right, top_right),
-        (top_right, top_left),
-    ]
-    for p1, p2 in segments:
-        femm.mi_addsegment(*p1, *p2)
-        x_seg = (p1[0] + p2[0]) / 2
-        y_seg = (p1[1] + p2[1]) / 2
-        femm.mi_selectsegment(x_seg, y_seg)
-        femm.mi_setsegmentprop("<None>", 0, 1, 0, group)
-        femm.mi_clearselected()
+    y_top = y_center + half_length
+    y_bottom = y_center - half_length
+    batch.mi_addnode(x_start, y_top)
+    batch.mi_addnode(x_start, y_bottom)
+    batch.mi_addnode(r, y_bottom)
+    batch.mi_addnode(r, y_top)
+    batch.add(_COIL_SIDES_LUA.format(x0=x_start, x1=r, y0=y_bottom, y1=y_top))
+    batch.mi_addsegment(x_start, y_bottom, r, y_bottom)
+    batch.mi_addsegment(r, y_top, x_start, y_top)
+    # Assign the four sides to the coil group at once: they are the only segments inside
+    # the coil rectangle, spools and spacers are drawn after all coils
+    batch.mi_selectrectangle(
+        x_start - _SELECT_MARGIN,
+        y_bottom - _SELECT_MARGIN,
+        r + _SELECT_MARGIN,
+        y_top + _SELECT_MARGIN,
+        1,
+    )
+    batch.mi_setsegmentprop("<None>", 0, 1, 0, group)
+    batch.mi_clearselected()
     return x_start + (r - x_start) / 2
 
-def add_coil_block(femm, x_center, y_center, coil, coil_label, group, nb_turns):
+def add_coil_block(batch, x_center, y_center, coil, coil_label, group, nb_turns):
     """Add block label and set coil properties."""
-    femm.mi_addblocklabel(x_center, y_center)
-    femm.mi_selectlabel(x_center, y_center)
-    femm.mi_setblockprop(
-        coil.material,
-        1,
-        0,
-        f"Coil{coil_label}",
-        0,
-        group,
-        nb_turns,
+    batch.add(
+        _COIL_BLOCK_LUA.format(
+            x=x_center,
+            y=y_center,
+            material=coil.material,
+            label=coil_label,
+            group=group,
+            turns=nb_turns,
+        )
     )
-    femm.mi_clearselected()
 
-def create_spool(femm, coil, y_center, half_length, r):
-    """Draw spool around coil if needed."""
-    coil_bottom_right = (r, y_center - half_length)
-    coil_top_right = (r, y_center + half_length)
+def create_spool(batch, coil, y_center, half_length, r):
+    """Draw spool around coil and return its label point."""
+    coil_bottom_y = y_center - half_length
+    coil_top_y = y_center + half_length
     spool_flange_length = coil.spool_flange_width
     half_spool_length = half_length + spool_flange_length
     spool_center_y = y_center
     spool_start_x = coil.spool_id / 2
     spool_end_x = coil.spool_od / 2
-    spool_top_left = (spool_start_x, spool_center_y + half_spool_length)
-    spool_bottom_left = (spool_start_x, spool_center_y - half_spool_length)
-    spool_bottom_right = (spool_end_x, spool_center_y - half_spool_length)
-    spool_bottom_right_upper_flange = (spool_end_x, spool_center_y - half_spool_length + spool_flange_length)
-    spool_top_right = (spool_end_x, spool_center_y + half_spool_length)
-    spool_top_right_inner_flange = (spool_end_x, spool_center_y + half_spool_length - spool_flange_length)
-    femm.mi_addnode(*spool_top_left)
-    femm.mi_addnode(*spool_bottom_left)
-    femm.mi_addnode(*spool_bottom_right)
-    femm.mi_addnode(*spool_bottom_right_upper_flange)
-    femm.mi_addnode(*spool_top_right)
-    femm.mi_addnode(*spool_top_right_inner_flange)
-    spool_segments = [
-        (spool_top_left, spool_bottom_left),
-        (spool_bottom_left, spool_bottom_right),
-        (spool_bottom_right, spool_bottom_right_upper_flange),
-        (spool_bottom_right_upper_flange, coil_bottom_right),
-        (coil_top_right, spool_top_right_inner_flange),
-        (spool_top_right_inner_flange, spool_top_right),
-        (spool_top_right, spool_top_left),
-    ]
-    for p1, p2 in spool_segments:
-        femm.mi_addsegment(*p1, *p2)
-        x_seg = (p1[0] + p2[0]) / 2
-        y_seg = (p1[1] + p2[1]) / 2
-        femm.mi_selectsegment(x_seg, y_seg)
-        femm.mi_setsegmentprop("<None>", 0, 1, 0, 4)
-        femm.mi_clearselected()
+    spool_top_y = spool_center_y + half_spool_length
+    spool_bottom_y = spool_center_y - half_spool_length
+    spool_lower_flange_y = spool_center_y - half_spool_length + spool_flange_length
+    spool_upper_flange_y = spool_center_y + half_spool_length - spool_flange_length
+    batch.mi_addnode(spool_start_x, spool_top_y)
+    batch.mi_addnode(spool_start_x, spool_bottom_y)
+    batch.mi_addnode(spool_end_x, spool_bottom_y)
+    batch.mi_addnode(spool_end_x, spool_lower_flange_y)
+    batch.mi_addnode(spool_end_x, spool_top_y)
+    batch.mi_addnode(spool_end_x, spool_upper_flange_y)
+    batch.add_segment(spool_start_x, spool_top_y, spool_start_x, spool_bottom_y, 4)
+    batch.add_segment(spool_start_x, spool_bottom_y, spool_end_x, spool_bottom_y, 4)
+    batch.add_segment(spool_end_x, spool_bottom_y, spool_end_x, spool_lower_flange_y, 4)
+    batch.add_segment(spool_end_x, spool_lower_flange_y, r, coil_bottom_y, 4)
+    batch.add_segment(r, coil_top_y, spool_end_x, spool_upper_flange_y, 4)
+    batch.add_segment(spool_end_x, spool_upper_flange_y, spool_end_x, spool_top_y, 4)
+    batch.add_segment(spool_end_x, spool_top_y, spool_start_x, spool_top_y, 4)
     spool_label_x = spool_start_x + (spool_end_x - spool_start_x) / 2
     spool_label_y = spool_center_y + half_spool_length - spool_flange_length / 2
-    femm.mi_addblocklabel(spool_label_x, spool_label_y)
-    femm.mi_selectlabel(spool_label_x, spool_label_y)
-    femm.mi_setblockprop(
-        coil.spool_material,
-        1,
-        0,
-        "",
-        0,
-        4,
-        0,
-    )
-    femm.mi_clearselected()
+    return (spool_label_x, spool_label_y)
 
-def create_coil_spacer(femm, coil, y_center, x_start, r):
-    """Draw spacer between coils if needed."""
-    spacer_length = coil.pitch - (coil.length + 2 * coil.spool_flange_width)
-    spacer_center_y = y_center + coil.pitch / 2
-    half_spacer = spacer_length / 2
-    if coil.spool_id != 0:
-        spacer_start_x = min(x_start, coil.spool_id / 2)
-    else:
-        spacer_start_x = x_start
-    spacer_end_x = max(r, coil.spool_od / 2)
-    spacer_top_left = (spacer_start_x, spacer_center_y + half_spacer)
-    spacer_bottom_left = (spacer_start_x, spacer_center_y - half_spacer)
-    spacer_bottom_right = (spacer_end_x, spacer_center_y - half_spacer)
-    spacer_top_right = (spacer_end_x, spacer_center_y + half_spacer)
-    femm.mi_addnode(*spacer_top_left)
-    femm.mi_addnode(*spacer_bottom_left)
-    femm.mi_addnode(*spacer_bottom_right)
-    femm.mi_addnode(*spacer_top_right)
-    spacer_segments = [
-        (spacer_top_left, spacer_bottom_left),
-        (spacer_bottom_left, spacer_bottom_right),
-        (spacer_bottom_right, spacer_top_right),
-        (spacer_top_right, spacer_top_left),
-    ]
-    for p1, p2 in spacer_segments:
-        femm.mi_addsegment(*p1, *p2)
-        x_seg = (p1[0] + p2[0]) / 2
-        y_seg = (p1[1] + p2[1]) / 2
-        femm.mi_selectsegment(x_seg, y_seg)
-        femm.mi_setsegmentprop("<None>", 0, 1, 0, 4)
-        femm.mi_clearselected()
+def create_coil_spacer(batch, spacer_center_y, half_spacer, spacer_start_x, spacer_end_x):
+    """Draw spacer between coils and return its label point."""
+    spacer_top_y = spacer_center_y + half_spacer
+    spacer_bottom_y = spacer_center_y - half_spacer
+    batch.mi_addnode(spacer_start_x, spacer_top_y)
+    batch.mi_addnode(spacer_start_x, spacer_bottom_y)
+    batch.mi_addnode(spacer_end_x, spacer_bottom_y)
+    batch.mi_addnode(spacer_end_x, spacer_top_y)
+    batch.add_segment(spacer_start_x, spacer_top_y, spacer_start_x, spacer_bottom_y, 4)
+    batch.add_segment(spacer_start_x, spacer_bottom_y, spacer_end_x, spacer_bottom_y, 4)
+    batch.add_segment(spacer_end_x, spacer_bottom_y, spacer_end_x, spacer_top_y, 4)
+    batch.add_segment(spacer_end_x, spacer_top_y, spacer_start_x, spacer_top_y, 4)
     spacer_label_x = spacer_start_x + (spacer_end_x - spacer_start_x) / 2
     spacer_label_y = spacer_center_y
-    femm.mi_addblocklabel(spacer_label_x, spacer_label_y)
-    femm.mi_selectlabel(spacer_label_x, spacer_label_y)
-    femm.mi_setblockprop(
-        coil.spacer_material,
-        1,
-        0,
-        "",
-        0,
-        4,
-        0,
-    )
-    femm.mi_clearselected()
+    return (spacer_label_x, spacer_label_y)
 
-def create_coils(femm, coil):
+def create_coils(batch, coil):
     """
     Create coils of the tubular linear motor from specified parameters.
     This function draws each coil, adds spools and spacers if needed.
+    Geometry is appended to the given Lua batch, which the caller sends to FEMM.
     """
     coil_labels = [("A", 1), ("B", 2), ("C", 3)]
-    total_height = (coil.number - 1) * coil.pitch
+    number = coil.number
+    pitch = coil.pitch
+    length = coil.length
+    spool_flange_width = coil.spool_flange_width
+    total_height = (number - 1) * pitch
     y_start = -total_height / 2 + coil.vertical_offset
-    for i in range(coil.number):
-        coil_label, group = coil_labels[(coil.number - 1 - i) % 3]
-        y_center = y_start + i * coil.pitch
-        half_length = coil.length / 2
-        r = coil.od / 2
-        x_start = coil.id / 2
+    y_centers = y_start + np.arange(number) * pitch
+    half_length = length / 2
+    r = coil.od / 2
+    x_start = coil.id / 2
+    has_spool = spool_flange_width > 0 and coil.spool_id <= coil.id and coil.spool_od >= coil.od
+    # Spacers sit halfway between consecutive coils and span the coils and their spools
+    spacer_length = pitch - (length + 2 * spool_flange_width)
+    if spacer_length > 0:
+        spacer_centers = (y_centers[:-1] + pitch / 2).tolist()
+    else:
+        spacer_centers = []
+    half_spacer = spacer_length / 2
+    spacer_start_x = min(x_start, coil.spool_id / 2) if coil.spool_id != 0 else x_start
+    spacer_end_x = max(r, coil.spool_od / 2)
+    y_centers = y_centers.tolist()
+    # Phase labels rotate along the stack, winding direction flips every group of 3 coils
+    # and is reversed for phase B: the (label, turns) pattern repeats every 6 coils
+    pattern = []
+    for i in range(6):
+        phase_index = (number - 1 - i) % 3
+        even_group = (i // 3) % 2 == 0
+        nb_turns = coil.nb_turn if even_group == (phase_index == 1) else -coil.nb_turn
+        pattern.append((coil_labels[phase_index], nb_turns))
+    for y_center, ((coil_label, group), nb_turns) in zip(y_centers, islice(cycle(pattern), number)):
         # Draw coil geometry
-        x_center = create_coil_geometry(femm, x_start, r, y_center, half_length, group)
-        group_index = i // 3
-        if group_index % 2 == 0:
-            nb_turns = coil.nb_turn if coil_label == "B" else -coil.nb_turn
-        else:
-            nb_turns = -coil.nb_turn if coil_label == "B" else coil.nb_turn
-        add_coil_block(femm, x_center, y_center, coil, coil_label, group, nb_turns)
+        x_center = create_coil_geometry(batch, x_start, r, y_center, half_length, group)
+        add_coil_block(batch, x_center, y_center, coil, coil_label, group, nb_turns)
 
-        # Add spool if needed
-        if (
-            coil.spool_flange_width > 0
-            and coil.spool_id <= coil.id
-            and coil.spool_od >= coil.od
-        ):
-            create_spool(femm, coil, y_center, half_length, r)
-
-        # Add spacer if needed
-        if (coil.length + 2 * coil.spool_flange_width) < coil.pitch and i < coil.number - 1:
-            create_coil_spacer(femm, coil, y_center, x_start, r)
+    # Spools and spacers move with the coils (group 4), their labels are set per material
+    if has_spool:
+        spool_labels = [create_spool(batch, coil, y_center, half_length, r) for y_center in y_centers]
+        batch.add_blocks(spool_labels, coil.spool_material, group=4)
+    spacer_labels = [
+        create_coil_spacer(batch, y_center, half_spacer, spacer_start_x, spacer_end_x)
+        for y_center in spacer_centers
+    ]
+    batch.add_blocks(spacer_labels, coil.spacer_material, group=4)
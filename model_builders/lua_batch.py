@@ -0,0 +1,101 @@
+"""
+Lua command batch used to send geometry to FEMM in a single call.
+"""
+
+
+# Coordinates are written with 10 significant digits: sub-micron precision on models up
+# to a metre, and cheaper to format than the shortest round-trip repr of a float
+class LuaBatch:
+    """
+    Accumulates FEMM preprocessor commands as Lua statements.
+    Exposes the same mi_* methods as pyfemm so builders can use it in place of the femm module.
+    """
+
+    def __init__(self):
+        # Statements are collected in a list and joined once in flush(): linear in the
+        # script size, unlike repeated string concatenation, and faster than io.StringIO
+        self._lines = []
+        # Nodes and segments already sent, keyed on coordinates rounded to 1e-6 mm
+        self._nodes = set()
+        self._segments = set()
+
+    def add(self, line):
+        """Append a raw Lua statement."""
+        self._lines.append(line)
+
+    def flush(self):
+        """Return the accumulated Lua script and empty the batch (known nodes and segments are kept)."""
+        script = "\n".join(self._lines)
+        self._lines = []
+        return script
+
+    def mi_addnode(self, x, y):
+        key = (round(x, 6), round(y, 6))
+        if key in self._nodes:
+            return
+        self._nodes.add(key)
+        self.add(f"mi_addnode({x:.10g},{y:.10g})")
+
+    def _is_new_segment(self, x1, y1, x2, y2):
+        """Record a segment, in either direction, and tell whether it was not sent yet."""
+        key = frozenset(((round(x1, 6), round(y1, 6)), (round(x2, 6), round(y2, 6))))
+        if key in self._segments:
+            return False
+        self._segments.add(key)
+        return True
+
+    def mi_addsegment(self, x1, y1, x2, y2):
+        if self._is_new_segment(x1, y1, x2, y2):
+            self.add(f"mi_addsegment({x1:.10g},{y1:.10g},{x2:.10g},{y2:.10g})")
+
+    def add_segment(self, x1, y1, x2, y2, group):
+        """Add a segment and assign it to a group, selecting it by its midpoint."""
+        if not self._is_new_segment(x1, y1, x2, y2):
+            return
+        self.add(f"mi_addsegment({x1:.10g},{y1:.10g},{x2:.10g},{y2:.10g})")
+        self.add(f"mi_selectsegment({(x1 + x2) / 2:.10g},{(y1 + y2) / 2:.10g})")
+        self.add(f'mi_setsegmentprop("<None>",0,1,0,{group})')
+        self.add("mi_clearselected()")
+
+    def mi_selectsegment(self, x, y):
+        self.add(f"mi_selectsegment({x:.10g},{y:.10g})")
+
+    def mi_selectrectangle(self, x1, y1, x2, y2, editmode):
+        self.add(f"mi_selectrectangle({x1:.10g},{y1:.10g},{x2:.10g},{y2:.10g},{editmode})")
+
+    def mi_setsegmentprop(self, propname, elementsize, automesh, hide, group):
+        self.add(f'mi_setsegmentprop("{propname}",{elementsize},{automesh},{hide},{group})')
+
+    def mi_addblocklabel(self, x, y):
+        self.add(f"mi_addblocklabel({x:.10g},{y:.10g})")
+
+    def mi_selectlabel(self, x, y):
+        self.add(f"mi_selectlabel({x:.10g},{y:.10g})")
+
+    def mi_setblockprop(self, blockname, automesh, meshsize, incircuit, magdir, group, turns):
+        self.add(
+            f'mi_setblockprop("{blockname}",{automesh},{meshsize},"{incircuit}",{magdir},{group},{turns})'
+        )
+
+    def add_blocks(self, label_points, blockname, magdir=0, group=0):
+        """
+        Add one block label per point and give them all the same properties.
+        Labels are selected together so the properties are set with a single mi_setblockprop.
+        """
+        if not label_points:
+            return
+        for x, y in label_points:
+            self.mi_addblocklabel(x, y)
+        for x, y in label_points:
+            self.mi_selectlabel(x, y)
+        self.mi_setblockprop(blockname, 1, 0, "", magdir, group, 0)
+        self.mi_clearselected()
+
+    def mi_clearselected(self):
+        self.add("mi_clearselected()")
+
+    def mi_addcircprop(self, circuitname, i, circuittype):
+        self.add(f'mi_addcircprop("{circuitname}",{i},{circuittype})')
+
+    def mi_makeABC(self, n, r, x, y, bc):
+        self.add(f"mi_makeABC({n},{r:.10g},{x:.10g},{y:.10g},{bc})")
@@ -1,69 +1,46 @@
 """
 Functions to build magnets geometry in FEMM.
 """
+import numpy as np
 
+# Lua template for the axis and outer sides of a magnet rectangle, from the axis to radius r.
+# Top and bottom sides are added separately: stacked magnets can share them
+_MAGNET_SIDES_LUA = (
+    "mi_addsegment(0,{y1:.10g},0,{y0:.10g})\n"
+    "mi_addsegment({r:.10g},{y0:.10g},{r:.10g},{y1:.10g})"
+)
 
-def create_magnet_geometry(femm, r, y_center, half_length):
+
+def create_magnet_geometry(batch, r, y_center, half_length):
     """Draw a single magnet rectangle in FEMM."""
-    top_left = (0, y_center + half_length)
-    bottom_left = (0, y_center - half_length)
-    bottom_right = (r, y_center - half_length)
-    top_right = (r, y_center + half_length)
-    femm.mi_addnode(*top_left)
-    femm.mi_addnode(*bottom_left)
-    femm.mi_addnode(*bottom_right)
-    femm.mi_addnode(*top_right)
-    femm.mi_addsegment(*top_left, *bottom_left)
-    femm.mi_addsegment(*bottom_left, *bottom_right)
-    femm.mi_addsegment(*bottom_right, *top_right)
-    femm.mi_addsegment(*top_right, *top_left)
+    y_top = y_center + half_length
+    y_bottom = y_center - half_length
+    batch.mi_addnode(0, y_top)
+    batch.mi_addnode(0, y_bottom)
+    batch.mi_addnode(r, y_bottom)
+    batch.mi_addnode(r, y_top)
+    batch.add(_MAGNET_SIDES_LUA.format(r=r, y0=y_bottom, y1=y_top))
+    batch.mi_addsegment(0, y_bottom, r, y_bottom)
+    batch.mi_addsegment(r, y_top, 0, y_top)
     return (r / 2, y_center)
 
-def add_magnet_block(femm, x_center, y_center, material, angle):
-    """Add block label and set magnet properties."""
-    femm.mi_addblocklabel(x_center, y_center)
-    femm.mi_selectlabel(x_center, y_center)
-    femm.mi_setblockprop(
-        material,
-        1,
-        0,
-        "",
-        angle,
-        0,
-        0,
-    )
-    femm.mi_clearselected()
-
-def create_spacer(femm, r, spacer_center_y, half_spacer, spacer_material):
-    """Draw a spacer between magnets."""
+def create_spacer(batch, r, spacer_center_y, half_spacer):
+    """Draw a spacer rectangle between magnets and return its label point."""
     spacer_top_left = (0, spacer_center_y + half_spacer)
     spacer_bottom_left = (0, spacer_center_y - half_spacer)
     spacer_bottom_right = (r, spacer_center_y - half_spacer)
     spacer_top_right = (r, spacer_center_y + half_spacer)
-    femm.mi_addnode(*spacer_top_left)
-    femm.mi_addnode(*spacer_bottom_left)
-    femm.mi_addnode(*spacer_bottom_right)
-    femm.mi_addnode(*spacer_top_right)
-    femm.mi_addsegment(*spacer_top_left, *spacer_bottom_left)
-    femm.mi_addsegment(*spacer_bottom_left, *spacer_bottom_right)
-    femm.mi_addsegment(*spacer_bottom_right, *spacer_top_right)
-    femm.mi_addsegment(*spacer_top_right, *spacer_top_left)
-    spacer_label_x = r / 2
-    spacer_label_y = spacer_center_y
-    femm.mi_addblocklabel(spacer_label_x, spacer_label_y)
-    femm.mi_selectlabel(spacer_label_x, spacer_label_y)
-    femm.mi_setblockprop(
-        spacer_material,
-        1,
-        0,
-        "",
-        0,
-        0,
-        0,
-    )
-    femm.mi_clearselected()
+    batch.mi_addnode(*spacer_top_left)
+    batch.mi_addnode(*spacer_bottom_left)
+    batch.mi_addnode(*spacer_bottom_right)
+    batch.mi_addnode(*spacer_top_right)
+    batch.mi_addsegment(*spacer_top_left, *spacer_bottom_left)
+    batch.mi_addsegment(*spacer_bottom_left, *spacer_bottom_right)
+    batch.mi_addsegment(*spacer_bottom_right, *spacer_top_right)
+    batch.mi_addsegment(*spacer_top_right, *spacer_top_left)
+    return (r / 2, spacer_center_y)
 
-def create_tube(femm, r, magnet, tube_material):
+def create_tube(batch, r, magnet, tube_material):
     """Draw tube around magnets if needed."""
     tube_half_height = magnet.number * magnet.pitch / 2
     tube_r = magnet.tube_od / 2
@@ -71,53 +48,51 @@ def create_tube(femm, r, magnet, tube_material):
     tube_bottom_left = (r, -tube_half_height)
     tube_bottom_right = (tube_r, -tube_half_height)
     tube_top_right = (tube_r, tube_half_height)
-    femm.mi_addnode(*tube_top_left)
-    femm.mi_addnode(*tube_bottom_left)
-    femm.mi_addnode(*tube_bottom_right)
-    femm.mi_addnode(*tube_top_right)
-    femm.mi_addsegment(*tube_top_left, *tube_bottom_left)
-    femm.mi_addsegment(*tube_bottom_left, *tube_bottom_right)
-    femm.mi_addsegment(*tube_bottom_right, *tube_top_right)
-    femm.mi_addsegment(*tube_top_right, *tube_top_left)
+    batch.mi_addnode(*tube_top_left)
+    batch.mi_addnode(*tube_bottom_left)
+    batch.mi_addnode(*tube_bottom_right)
+    batch.mi_addnode(*tube_top_right)
+    batch.mi_addsegment(*tube_top_left, *tube_bottom_left)
+    batch.mi_addsegment(*tube_bottom_left, *tube_bottom_right)
+    batch.mi_addsegment(*tube_bottom_right, *tube_top_right)
+    batch.mi_addsegment(*tube_top_right, *tube_top_left)
     tube_label_x = tube_r - (tube_r - r) / 2
     tube_label_y = 0
-    femm.mi_addblocklabel(tube_label_x, tube_label_y)
-    femm.mi_selectlabel(tube_label_x, tube_label_y)
-    femm.mi_setblockprop(
-        tube_material,
-        1,
-        0,
-        "",
-        0,
-        0,
-        0,
-    )
-    femm.mi_clearselected()
+    batch.add_blocks([(tube_label_x, tube_label_y)], tube_material)
 
-def create_magnets(femm, magnet):
+def create_magnets(batch, magnet):
     """
     Create magnets of the tubular linear motor from specified parameters.
     This function draws each magnet, adds spacers if needed, and draws the tube if specified.
+    Geometry is appended to the given Lua batch, which the caller sends to FEMM.
     """
-    total_height = (magnet.number - 1) * magnet.pitch
+    number = magnet.number
+    pitch = magnet.pitch
+    length = magnet.length
+    material = magnet.material
+    spacer_material = magnet.spacer_material
+    total_height = (number - 1) * pitch
     y_start = -total_height / 2
+    y_centers = y_start + np.arange(number) * pitch
     r = magnet.od / 2
-    for i in range(magnet.number):
-        y_center = y_start + i * magnet.pitch
-        half_length = magnet.length / 2
-        # Draw magnet geometry
-        x_center, y_center_label = create_magnet_geometry(femm, r, y_center, half_length)
-        # Alternate magnetization angle for each magnet
-        magnetization_angle = -90 if i % 2 == 0 else 90
-        add_magnet_block(femm, x_center, y_center_label, magnet.material, magnetization_angle)
+    half_length = length / 2
+    # Spacers sit halfway between consecutive magnets
+    spacer_centers = (y_centers[:-1] + pitch / 2).tolist() if length < pitch else []
+    half_spacer = (pitch - length) / 2
+
+    # Draw magnet geometry, label points are kept to set block properties afterwards
+    labels = [
+        create_magnet_geometry(batch, r, y_center, half_length) for y_center in y_centers.tolist()
+    ]
+    spacer_labels = [
+        create_spacer(batch, r, y_center, half_spacer) for y_center in spacer_centers
+    ]
 
-        # Add spacer if needed
-        if magnet.length < magnet.pitch and i < magnet.number - 1:
-            spacer_length = magnet.pitch - magnet.length
-            spacer_center_y = y_center + magnet.pitch / 2
-            half_spacer = spacer_length / 2
-            create_spacer(femm, r, spacer_center_y, half_spacer, magnet.spacer_material)
+    # Magnetization alternates from one magnet to the next: -90 degrees for even magnets
+    batch.add_blocks(labels[0::2], material, -90)
+    batch.add_blocks(labels[1::2], material, 90)
+    batch.add_blocks(spacer_labels, spacer_material)
 
     # Draw tube if needed
     if magnet.tube_od > magnet.od:
-        create_tube(femm, r, magnet, magnet.tube_material)
+        create_tube(batch, r, magnet, magnet.tube_material)
@@ -4,7 +4,7 @@ Data class for coil parameters used in FEMM simulations.
 from dataclasses import dataclass
 from typing import Optional
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class Coil:
     """Coil parameters for FEMM simulation."""
     id: Optional[float] = None
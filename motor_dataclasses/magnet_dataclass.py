@@ -4,7 +4,7 @@ Data class for magnet parameters used in FEMM simulations.
 from dataclasses import dataclass
 from typing import Optional
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class Magnet:
     """Magnet parameters for FEMM simulation."""
     od: Optional[float] = None
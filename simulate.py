@@ -1,33 +1,154 @@
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Optional
+import csv
+import math
+import os
 import sys
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
 
 from create_model import CreateModel
 from femm_model import FEMMModel
-from simulation_result import SimulationResult
+from femm_session import close_femm
+from simulation_result import COLUMNS, SimulationResult
 
 
-def run_simulation(femm_model: FEMMModel, start: float, end: float, step: float) -> list:
-    """Run the simulation over a range of positions and collect results."""
-    results = []
+def sweep_positions(start: float, end: float, step: float) -> list:
+    """
+    Return the absolute positions of a sweep: start, start + step, ... up to end included
+    when it falls on the grid. Computed from the step index to avoid accumulating rounding.
+    """
+    # The tolerance absorbs rounding in the ratio, e.g. (0.3 - 0) / 0.1 = 2.9999999999999996
+    nb_steps = math.floor((end - start) / step + 1e-9)
+    return [float(start + index * step) for index in range(nb_steps + 1)]
 
-    femm_model.translate_and_set_currents(start)
-    femm_model.mesh_and_solve()
-    results.append(SimulationResult(femm_model).results)
 
-    for _ in np.arange(start, end, step):
-        femm_model.translate_and_set_currents(step)
-        femm_model.mesh_and_solve()
-        results.append(SimulationResult(femm_model).results)
-        print(f"Simulated position: {femm_model.offset_pos:.2f}")
+def _allocate_columns(size: int) -> dict:
+    """Preallocate one float array per result column."""
+    return {column: np.empty(size) for column in COLUMNS}
 
-    return results
+
+def _to_dataframe(positions: list, columns: dict) -> pd.DataFrame:
+    """Build the results table, indexed by position, from filled column arrays."""
+    return pd.DataFrame(columns, index=pd.Index(positions, name="Position"))
+
+
+def _solve_positions(
+    femm_model: FEMMModel, positions: list, csv_path: Optional[Path] = None, progress: bool = False
+) -> pd.DataFrame:
+    """
+    Solve each absolute position in turn and return the results table.
+    When csv_path is given, each row is also appended to that CSV as soon as it is solved,
+    so a long sweep keeps its results if it is interrupted.
+    """
+    currents = femm_model.compute_currents(positions).tolist()
+    nb_positions = len(positions)
+    columns = _allocate_columns(nb_positions)
+    csv_file = None
+    if csv_path is not None:
+        csv_file = open(csv_path, "w", newline="")
+        csv_writer = csv.writer(csv_file, lineterminator="\n")
+        csv_writer.writerow(("Position",) + COLUMNS)
+    try:
+        for index in range(nb_positions):
+            femm_model.translate_to(positions[index], currents[index])
+            # De-energized coils need no solve, SimulationResult reports zero forces
+            if any(currents[index]):
+                femm_model.mesh_and_solve()
+            result = SimulationResult(femm_model)
+            result.store(columns, index)
+            if csv_file is not None:
+                csv_writer.writerow(result.as_record())
+                csv_file.flush()
+            if progress:
+                # Progress is rewritten in place on a single line
+                print(
+                    f"\rSimulated position: {femm_model.offset_pos:.2f} ({index + 1}/{nb_positions})",
+                    end="",
+                    flush=True,
+                )
+    finally:
+        if csv_file is not None:
+            csv_file.close()
+    if progress:
+        print()
+    return _to_dataframe(positions, columns)
+
+
+def run_simulation(
+    femm_model: FEMMModel, start: float, end: float, step: float, csv_path: Optional[Path] = None
+) -> pd.DataFrame:
+    """
+    Run the simulation over a range of positions and collect results.
+    Rows are streamed to csv_path, if given, as they are solved.
+    """
+    positions = sweep_positions(start, end, step)
+    return _solve_positions(femm_model, positions, csv_path, progress=True)
+
+
+def _simulate_positions(model_kwargs: dict, positions: list, csv_path: Path) -> pd.DataFrame:
+    """Solve a list of absolute positions in a private FEMM instance (worker process)."""
+    with FEMMModel(**model_kwargs) as femm_model:
+        return _solve_positions(femm_model, positions, csv_path)
+
+
+def run_parallel_simulation(
+    model_kwargs: dict,
+    start: float,
+    end: float,
+    step: float,
+    nb_worker: Optional[int],
+    csv_path: Path,
+) -> pd.DataFrame:
+    """
+    Run the simulation over a range of positions split across several FEMM worker processes.
+    Positions are the same as run_simulation. Results are returned sorted by position.
+    nb_worker defaults to one worker per CPU core, and never exceeds the number of positions.
+    Each worker streams its rows to its own <csv_path stem>_<worker>.csv next to csv_path.
+    Once every worker has finished, the rows are merged into csv_path and the worker files removed.
+    """
+    positions = sweep_positions(start, end, step)
+    if not positions:
+        df_results = _to_dataframe(positions, _allocate_columns(0))
+        df_results.to_csv(csv_path)
+        return df_results
+    # FEMM solves on a single thread: one instance per core keeps every core busy
+    nb_worker = min(nb_worker or os.cpu_count() or 1, len(positions))
+    worker_paths = [csv_path.with_name(f"{csv_path.stem}_{worker}.csv") for worker in range(nb_worker)]
+    with ProcessPoolExecutor(max_workers=nb_worker) as executor:
+        futures = [
+            executor.submit(_simulate_positions, model_kwargs, positions[worker::nb_worker], worker_path)
+            for worker, worker_path in enumerate(worker_paths)
+        ]
+        frames = []
+        nb_solved = 0
+        for future in as_completed(futures):
+            frames.append(future.result())
+            nb_solved += len(frames[-1])
+            print(f"\rSimulated positions: {nb_solved}/{len(positions)}", end="", flush=True)
+        print()
+    df_results = pd.concat(frames).sort_index()
+    df_results.to_csv(csv_path)
+    # Worker files are only kept when a run fails
+    for worker_path in worker_paths:
+        worker_path.unlink()
+    return df_results
 
 
 def plot_results(df_result: pd.DataFrame, output_dir: Path):
-    """Plot force and current curves from simulation results."""
+    """
+    Plot force and current curves from simulation results and save them as a PNG.
+    The figure is only shown with an interactive backend and a display available.
+    """
+    # Imported here so FEMM worker processes, which re-import this module, never load matplotlib
+    import matplotlib
+
+    headless = sys.platform != "win32" and not os.environ.get("DISPLAY")
+    if headless:
+        matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
     _, ax1 = plt.subplots(figsize=(10, 6))
     color_list = ["tab:blue", "tab:orange", "tab:green", "tab:red"]
 
@@ -65,7 +186,10 @@ def plot_results(df_result: pd.DataFrame, output_dir: Path):
 
     plt.tight_layout()
     plt.savefig(output_dir / "Results_Force_Currents.png")
-    plt.show()
+    # Agg is also what matplotlib picks by itself, or what MPLBACKEND sets, on batch runs
+    if not headless and matplotlib.get_backend().lower() != "agg":
+        plt.show()
+    plt.close()
 
 
 if __name__ == "__main__":
@@ -77,6 +201,11 @@ if __name__ == "__main__":
     START_POSITION = -20  # in mm
     END_POSITION = 20
     STEP_SIZE = 1
+    # Number of FEMM instances solving positions in parallel
+    # (1 = single FEMM instance, None = one per CPU core)
+    NB_WORKER = 1
+    # Plot the force and current curves at the end of the sweep (False for batch runs)
+    PLOT_RESULTS = True
 
     # Model parameters automatically updated from Yaml if "generate" or hardcoded here for "load"
     PEAK_CURRENT = 3.0  # in A
@@ -91,6 +220,7 @@ if __name__ == "__main__":
             sys.exit(1)
         print(f"Load parameters from: {yaml_path}")
         try:
+            # FEMM is left open for the simulation, a serial run solves in the same instance
             model_builder = CreateModel(yaml_path)
             model_builder.build()
             print("Model successfully generated.")
@@ -100,6 +230,7 @@ if __name__ == "__main__":
             COIL_PITCH = model_builder.coil_params.pitch
         except Exception as e:
             print(f"Error: {e}")
+            close_femm()
             sys.exit(1)
 
     elif simulation_mode == "load":
@@ -113,26 +244,43 @@ if __name__ == "__main__":
     # Check FEM file exists
     if not fem_file_path.exists():
         print(f"Error: FEM file not found: {fem_file_path}")
+        close_femm()
         sys.exit(1)
 
+    # Make "out" dir if not exists
+    output_dir = Path("out")
+    output_dir.mkdir(exist_ok=True)
+
+    model_kwargs = {
+        "model_path": fem_file_path,
+        "peak_current": PEAK_CURRENT,
+        "pole_length": POLE_LENGTH,
+        "coil_pitch": COIL_PITCH,
+    }
+    results_path = output_dir / "SimulationResults.csv"
     try:
-        print(f"Loading FEM model from: {fem_file_path}")
-        femm_model = FEMMModel(
-            model_path=fem_file_path,
-            peak_current=PEAK_CURRENT,
-            pole_length=POLE_LENGTH,
-            coil_pitch=COIL_PITCH,
-        )
+        if NB_WORKER is None or NB_WORKER > 1:
+            # Workers run their own FEMM instances, the one that built the model is not needed
+            close_femm()
+            print(f"Simulating FEM model {fem_file_path} with {NB_WORKER or os.cpu_count()} FEMM workers")
+            # Per-worker CSV files are merged into results_path, sorted by position
+            df_results = run_parallel_simulation(
+                model_kwargs, START_POSITION, END_POSITION, STEP_SIZE, NB_WORKER, results_path
+            )
+        else:
+            print(f"Loading FEM model from: {fem_file_path}")
+            with FEMMModel(**model_kwargs) as femm_model:
+                # Rows are written to the CSV as each position is solved
+                df_results = run_simulation(
+                    femm_model, START_POSITION, END_POSITION, STEP_SIZE, csv_path=results_path
+                )
     except Exception as e:
         print(f"Simulation error: {e}")
         sys.exit(1)
+    finally:
+        # Still open when it was started by CreateModel.build, FEMMModel only closes its own
+        close_femm()
 
-    # Make "out" dir if not exists
-    output_dir = Path("out")
-    output_dir.mkdir(exist_ok=True)
-
-    simulation_results = run_simulation(femm_model, START_POSITION, END_POSITION, STEP_SIZE)
-    df_results = pd.json_normalize(simulation_results).set_index("Position")
-    df_results.to_csv(output_dir / "SimulationResults.csv")
-    plot_results(df_results, output_dir)
+    if PLOT_RESULTS:
+        plot_results(df_results, output_dir)
     print("Simulation completed successfully. Results saved in SimulationResults.csv")
@@ -1,37 +1,100 @@
-from dataclasses import dataclass, field
-from typing import Dict
-import femm
+from dataclasses import dataclass
+from typing import Dict, Iterable, Tuple
+import numpy as np
 
+from femm_session import run_lua
 
-@dataclass
+_COILS = ("CoilA", "CoilB", "CoilC")
+
+# Flat result columns, named "<quantity>.<coil>" after the nested results keys
+COLUMNS = (
+    "Current.CoilA",
+    "Current.CoilB",
+    "Current.CoilC",
+    "Force.CoilA",
+    "Force.CoilB",
+    "Force.CoilC",
+    "Force.Sum",
+)
+
+# One field per value, for stacking results into a structured array. FEMM reports forces
+# to about 6 significant digits, float32 holds them at half the size; positions stay float64
+# so they remain exact sweep keys
+RECORD_DTYPE = np.dtype([("Position", "f8")] + [(column, "f4") for column in COLUMNS])
+
+# Every solve writes a new solution file, which has to be loaded again at each step.
+# Loading it and setting up the view are sent as one Lua script
+_LOAD_SOLUTION_LUA = 'mi_loadsolution()\nmo_smooth("off")\nmo_hidecontourplot()'
+# mo_blockintegral code of the axial force on a coil: 19 is the z part of the weighted stress
+# tensor force. 12, the z part of the Lorentz force (integral of J x B over the block), is a
+# cheaper alternative valid for the non-magnetic coil blocks, with slightly different values
+_FORCE_INTEGRAL = 19
+# Coil groups are integrated in the same script, into locals f1 to f3 that it returns: unlike
+# globals, they cannot carry the forces of a previous step over. Nothing is selected in a
+# freshly loaded solution: each group is cleared after its integral only
+_COMPUTE_FORCES_LUA = "\n".join(
+    [_LOAD_SOLUTION_LUA]
+    + [
+        f"mo_groupselectblock({group})\n"
+        f"local f{group} = mo_blockintegral({_FORCE_INTEGRAL})\nmo_clearblock()"
+        for group in (1, 2, 3)
+    ]
+)
+_FORCES_EXPR = ("f1", "f2", "f3")
+
+
+@dataclass(slots=True)
 class SimulationResult:
     """Stores and extracts forces and currents from a solved FEMM model."""
     position: float
-    currents: Dict[str, float]
-    results: Dict = field(default_factory=dict)
+    # Coil A, B and C currents, snapshot of the model's immutable currents tuple
+    currents: Tuple[float, float, float]
+    # Coil A, B and C forces, their sum is computed on access by force_sum
+    forces: Tuple[float, float, float]
 
     def __init__(self, femm_model):
         self.position = femm_model.offset_pos
-        self.results = {
+        self.currents = femm_model.currents
+        if any(self.currents):
+            self._compute_forces()
+        else:
+            # Coil blocks are non-magnetic: without current they carry no force,
+            # there is no solution to post-process
+            self.forces = (0.0, 0.0, 0.0)
+
+    @property
+    def force_sum(self) -> float:
+        """Total force on the coils: forces on disjoint block groups add up."""
+        forces = self.forces
+        return forces[0] + forces[1] + forces[2]
+
+    @property
+    def results(self) -> Dict:
+        """Nested view of the result: position, currents and forces keyed by coil name."""
+        return {
             "Position": self.position,
-            "Current": femm_model.currents.copy(),
+            "Current": dict(zip(_COILS, self.currents)),
+            "Force": {**dict(zip(_COILS, self.forces)), "Sum": self.force_sum},
         }
-        self._compute_forces()
+
+    def as_record(self) -> Tuple[float, ...]:
+        """Flat (position, currents A-C, forces A-C, force sum) tuple, in RECORD_DTYPE order."""
+        return (self.position,) + self.currents + self.forces + (self.force_sum,)
+
+    @classmethod
+    def stack(cls, results: Iterable["SimulationResult"]) -> np.ndarray:
+        """Stack results into a structured array with one RECORD_DTYPE row per result."""
+        return np.array([result.as_record() for result in results], dtype=RECORD_DTYPE)
+
+    def store(self, columns: Dict, index: int):
+        """Write this result into row index of preallocated column arrays keyed by COLUMNS."""
+        for column, value in zip(COLUMNS, self.currents + self.forces + (self.force_sum,)):
+            columns[column][index] = value
 
     def _compute_forces(self):
         """Extracts forces from FEMM model."""
-        femm.mi_loadsolution()
-        femm.mo_smooth("off")
-        femm.mo_hidecontourplot()
-        self.results["Force"] = {}
-        for i, coil in enumerate(["CoilA", "CoilB", "CoilC"], start=1):
-            femm.mo_clearblock()
-            femm.mo_groupselectblock(i)
-            force = femm.mo_blockintegral(19)
-            self.results["Force"][coil] = force
-        femm.mo_clearblock()
-        for group in [1, 2, 3]:
-            femm.mo_groupselectblock(group)
-        total_force = femm.mo_blockintegral(19)
-        self.results["Force"]["Sum"] = total_force
-        femm.mo_clearblock()
+        # The integrals are returned by the script that computes them
+        forces = tuple(run_lua(_COMPUTE_FORCES_LUA, _FORCES_EXPR))
+        if not all(isinstance(force, (int, float)) for force in forces):
+            raise RuntimeError(f"FEMM returned invalid coil forces: {forces}")
+        self.forces = forces